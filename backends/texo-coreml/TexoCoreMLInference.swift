@@ -2,15 +2,15 @@
 // TexoCoreMLInference.swift - CoreML-based equation recognition with beam search
 
 import CoreML
+import CoreVideo
 import Foundation
 import CoreGraphics
 
 // MARK: - Constants
 
 private let IMAGE_SIZE = 384
-private let MEAN: Float = 0.7931
-private let STD: Float = 0.1738
 private let ENC_SEQ_LEN = 144  // (384/32)^2 after HGNetv2 downsampling
+private let DECODER_SEQ_LENS = [1, 16, 64, 128, 256, 512]  // Enumerated decoder input lengths
 
 // MARK: - Beam Search Hypothesis
 
@@ -88,11 +88,11 @@ class TexoCoreMLInference {
         }
 
         // 1. Preprocess image
-        let pixelValues = try preprocessImage(image)
+        let pixelBuffer = try preprocessImage(image)
 
         // 2. Run encoder
         let encoderInput = try MLDictionaryFeatureProvider(dictionary: [
-            "pixel_values": MLFeatureValue(multiArray: pixelValues)
+            "pixel_values": MLFeatureValue(pixelBuffer: pixelBuffer)
         ])
         let encoderOutput = try await encoder.prediction(from: encoderInput)
         guard let encoderHiddenStates = encoderOutput.featureValue(for: "encoder_output")?.multiArrayValue else {
@@ -110,7 +110,7 @@ class TexoCoreMLInference {
 
     // MARK: - Image Preprocessing
 
-    private func preprocessImage(_ image: CGImage) throws -> MLMultiArray {
+    private func preprocessImage(_ image: CGImage) throws -> CVPixelBuffer {
         // 1. Convert to grayscale and get pixel data
         let width = image.width
         let height = image.height
@@ -147,27 +147,37 @@ class TexoCoreMLInference {
         // 4. Resize to IMAGE_SIZE x IMAGE_SIZE preserving aspect ratio, pad with black
         let resizedData = try resizeWithPadding(image: croppedCGImage, targetSize: IMAGE_SIZE)
 
-        // 5. Convert to MLMultiArray with normalization
-        // Shape: (1, 3, IMAGE_SIZE, IMAGE_SIZE)
-        let pixelValues = try MLMultiArray(shape: [1, 3, IMAGE_SIZE, IMAGE_SIZE] as [NSNumber], dataType: .float32)
+        // 5. Copy into a grayscale pixel buffer; the encoder normalizes it itself
+        var buffer: CVPixelBuffer?
+        let attributes = [kCVPixelBufferIOSurfacePropertiesKey as String: [String: Any]()] as CFDictionary
+        guard CVPixelBufferCreate(
+                  kCFAllocatorDefault,
+                  IMAGE_SIZE,
+                  IMAGE_SIZE,
+                  kCVPixelFormatType_OneComponent8,
+                  attributes,
+                  &buffer
+              ) == kCVReturnSuccess,
+              let pixelBuffer = buffer else {
+            throw CoreMLError.imageProcessingFailed
+        }
 
-        let ptr = pixelValues.dataPointer.bindMemory(to: Float.self, capacity: 3 * IMAGE_SIZE * IMAGE_SIZE)
+        CVPixelBufferLockBaseAddress(pixelBuffer, [])
+        defer { CVPixelBufferUnlockBaseAddress(pixelBuffer, []) }
 
-        // Fill all 3 channels with the same grayscale value (normalized)
-        for y in 0..<IMAGE_SIZE {
-            for x in 0..<IMAGE_SIZE {
-                let pixelIndex = y * IMAGE_SIZE + x
-                let grayValue = Float(resizedData[pixelIndex]) / 255.0
-                let normalized = (grayValue - MEAN) / STD
+        guard let baseAddress = CVPixelBufferGetBaseAddress(pixelBuffer) else {
+            throw CoreMLError.imageProcessingFailed
+        }
 
-                // Channel-first format: (C, H, W)
-                ptr[0 * IMAGE_SIZE * IMAGE_SIZE + pixelIndex] = normalized  // R
-                ptr[1 * IMAGE_SIZE * IMAGE_SIZE + pixelIndex] = normalized  // G
-                ptr[2 * IMAGE_SIZE * IMAGE_SIZE + pixelIndex] = normalized  // B
+        // Rows may be padded, so copy one row at a time
+        let bytesPerRow = CVPixelBufferGetBytesPerRow(pixelBuffer)
+        resizedData.withUnsafeBytes { pixels in
+            for y in 0..<IMAGE_SIZE {
+                memcpy(baseAddress + y * bytesPerRow, pixels.baseAddress! + y * IMAGE_SIZE, IMAGE_SIZE)
             }
         }
 
-        return pixelValues
+        return pixelBuffer
     }
 
     private func cropMargins(grayPixels: UnsafePointer<UInt8>, width: Int, height: Int) -> CGRect {
@@ -338,8 +348,12 @@ class TexoCoreMLInference {
     // MARK: - Helper Functions
 
     private func createInputIds(_ tokens: [Int]) throws -> MLMultiArray {
-        let inputIds = try MLMultiArray(shape: [1, tokens.count as NSNumber], dataType: .int32)
-        for (i, token) in tokens.enumerated() {
+        // Pad to the next enumerated length; the decoder is causal, so the
+        // logits at the real positions are unaffected by the padding
+        let paddedLength = DECODER_SEQ_LENS.first { $0 >= tokens.count } ?? tokens.count
+        let inputIds = try MLMultiArray(shape: [1, paddedLength as NSNumber], dataType: .int32)
+        for i in 0..<paddedLength {
+            let token = i < tokens.count ? tokens[i] : TexoCoreMLTokenizer.padTokenId
             inputIds[i] = NSNumber(value: Int32(token))
         }
         return inputIds
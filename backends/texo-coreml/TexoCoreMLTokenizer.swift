@@ -18,19 +18,40 @@ class TexoCoreMLTokenizer {
 
     init() {}
 
-    /// Load vocabulary from a JSON file.
-    /// - Parameter url: URL to the vocab.json file
+    /// Load vocabulary from the packed vocab.bin written by export_coreml.py.
+    /// Layout (little-endian): u32 count, u32 offsets[count], then the UTF-8 token bytes;
+    /// token i spans offsets[i] up to offsets[i + 1] (or the end of the data).
+    /// - Parameter url: URL to the vocab.bin file
     func loadVocabulary(from url: URL) throws {
         let data = try Data(contentsOf: url)
-        let json = try JSONSerialization.jsonObject(with: data) as? [String: Any]
+        let readUInt32: (Int) -> Int = { index in
+            Int(UInt32(littleEndian: data.withUnsafeBytes {
+                $0.loadUnaligned(fromByteOffset: index * 4, as: UInt32.self)
+            }))
+        }
 
-        guard let vocabDict = json?["vocab"] as? [String: Int] else {
+        guard data.count >= 4 else {
+            throw TokenizerError.invalidVocabularyFormat
+        }
+        let count = readUInt32(0)
+        let headerSize = 4 * (count + 1)
+        guard data.count >= headerSize else {
             throw TokenizerError.invalidVocabularyFormat
         }
 
-        self.vocab = vocabDict
-        self.reverseVocab = Dictionary(uniqueKeysWithValues: vocabDict.map { ($1, $0) })
-        self.vocabSize = vocabDict.count
+        var vocabDict: [String: Int] = [:]
+        vocabDict.reserveCapacity(count)
+        for id in 0..<count {
+            let start = headerSize + readUInt32(id + 1)
+            let end = id + 1 < count ? headerSize + readUInt32(id + 2) : data.count
+            guard start <= end, end <= data.count,
+                  let token = String(data: data[start..<end], encoding: .utf8) else {
+                throw TokenizerError.invalidVocabularyFormat
+            }
+            vocabDict[token] = id
+        }
+
+        loadVocabulary(from: vocabDict)
     }
 
     /// Load vocabulary from embedded vocab data.
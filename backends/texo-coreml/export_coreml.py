@@ -10,21 +10,32 @@ Requirements:
 - Run ./setup.sh first to clone Texo and download the model
 - coremltools >= 8.0
 - torch >= 2.0
-- transformers >= 4.40
+- transformers >= 4.57
 
 Usage:
     ./setup.sh  # First time only
-    uv run python export_coreml.py [--output-dir OUTPUT_DIR] [--no-optimize]
+    uv run python export_coreml.py [--output-dir OUTPUT_DIR] [--palettize-bits BITS] [--quantize-int8]
 """
 
 import argparse
 import json
+from contextlib import contextmanager
+import shutil
+import struct
 import sys
 import warnings
 from pathlib import Path
 
 import coremltools as ct
 import numpy as np
+from coremltools.optimize.coreml import (
+    OpLinearQuantizerConfig,
+    OpPalettizerConfig,
+    OptimizationConfig,
+    linear_quantize_weights,
+    palettize_weights,
+)
+from PIL import Image
 import torch
 import torch.nn as nn
 from torch.export import export, Dim
@@ -57,15 +68,89 @@ from texo.model.hgnet2 import HGNetv2, HGNetv2Config
 AutoConfig.register("my_hgnetv2", HGNetv2Config)
 AutoModel.register(HGNetv2Config, HGNetv2)
 
-from transformers import VisionEncoderDecoderModel
+from transformers import AttentionInterface, VisionEncoderDecoderModel
 
 # Image preprocessing constants
 IMAGE_SIZE = 384
+IMAGE_MEAN = 0.7931
+IMAGE_STD = 0.1738
 ENC_SEQ_LEN = 144  # (384/32)^2 after HGNetv2 downsampling
 
+# Beam search parameters baked into the stateful decoder step
+NUM_BEAMS = 4
+BEAM_CANDIDATES = 2 * NUM_BEAMS  # Per beam, so NUM_BEAMS survive when some hit EOS
+MAX_SEQ_LEN = 512
+
+# Decoder input_ids lengths; the app pads each prefix up to the next one
+DECODER_SEQ_LENS = (1, 16, 64, 128, 256, MAX_SEQ_LEN)
+PAD_TOKEN_ID = 1
+
+# Float16-safe decoder attention
+ATTN_PRESCALE = 32.0  # c in softmax(((q / (c * sqrt(d))) @ k - max) * c + mask)
+MASK_VALUE = -1e4  # Finite stand-in for the causal mask's finfo(float32).min
+
+
+def fp16_safe_attention(
+    module, query, key, value, attention_mask, scaling=None, dropout=0.0, head_mask=None, **kwargs
+):
+    """
+    Eager attention rewritten to stay inside float16 range.
+
+    Query is pre-scaled by 1/c so q @ k stays far below 65504, the row max is
+    subtracted, and the scores are scaled back by c. This equals the usual
+    softmax(q @ k * scaling + mask) since softmax ignores the per-row shift.
+    """
+    if scaling is None:
+        scaling = query.size(-1) ** -0.5
+
+    query = query * (scaling / ATTN_PRESCALE)
+    attn_weights = torch.matmul(query, key.transpose(2, 3))
+    attn_weights = attn_weights - attn_weights.amax(dim=-1, keepdim=True)
+    attn_weights = attn_weights * ATTN_PRESCALE
+    if attention_mask is not None:
+        attn_weights = attn_weights + attention_mask.clamp(min=MASK_VALUE)
+
+    attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+    attn_output = torch.matmul(attn_weights, value).transpose(1, 2).contiguous()
+    return attn_output, attn_weights
+
+
+AttentionInterface.register("fp16_safe", fp16_safe_attention)
+
+
+@contextmanager
+def attn_implementation(decoder, name: str):
+    """
+    Temporarily switch the decoder's attention implementation.
+
+    The config is shared with every other use of the decoder, so it is
+    restored afterwards to keep the PyTorch references on the original attention.
+    """
+    previous = decoder.config._attn_implementation
+    decoder.config._attn_implementation = name
+    try:
+        yield
+    finally:
+        decoder.config._attn_implementation = previous
+
+
+def is_mask_add(op):
+    """Select the add that applies the attention mask right before softmax."""
+    return op.op_type == "add" and any(
+        child.op_type == "softmax" for child in op.outputs[0].child_ops
+    )
+
+
+def is_stem_conv(op):
+    """Select the encoder's first conv, which reads the input image directly."""
+    if op.op_type != "conv":
+        return False
+    first_conv = next(o for o in op.enclosing_block.operations if o.op_type == "conv")
+    return op is first_conv
+
 
 class EncoderWrapper(nn.Module):
-    """Wrapper for the encoder + projection layer."""
+    """Wrapper for the encoder + projection layer, taking a normalized grayscale image."""
 
     def __init__(self, encoder, enc_to_dec_proj):
         super().__init__()
@@ -73,13 +158,15 @@ class EncoderWrapper(nn.Module):
         self.enc_to_dec_proj = enc_to_dec_proj
 
     def forward(self, pixel_values):
+        # The encoder expects the gray channel repeated as RGB
+        pixel_values = pixel_values.expand(-1, 3, -1, -1)
         encoder_output = self.encoder(pixel_values).last_hidden_state
         projected = self.enc_to_dec_proj(encoder_output)
         return projected
 
 
 class DecoderWrapper(nn.Module):
-    """Wrapper for decoder that disables KV-cache for simpler export."""
+    """Wrapper for decoder that disables KV-cache."""
 
     def __init__(self, decoder):
         super().__init__()
@@ -96,6 +183,86 @@ class DecoderWrapper(nn.Module):
         return outputs.logits
 
 
+class StatefulDecoderWrapper(nn.Module):
+    """
+    Single-token decoder step for all beams, with the self-attention KV-cache
+    held in a CoreML state instead of recomputing the full prefix each step.
+
+    Inputs are the next token of each beam, its position, the beam each row
+    continues from (used to reorder the cache), and the encoder output.
+    Assumes FormulaNet's MBart decoder layout (pre-norm layers).
+    """
+
+    def __init__(self, decoder, num_beams: int = NUM_BEAMS, max_seq_len: int = MAX_SEQ_LEN):
+        super().__init__()
+        self.decoder = decoder.model.decoder
+        self.lm_head = decoder.lm_head
+        self.num_heads = decoder.config.decoder_attention_heads
+        self.head_dim = decoder.config.d_model // self.num_heads
+        self.max_seq_len = max_seq_len
+
+        # (layer, key/value, beam, head, position, head_dim)
+        cache_shape = (len(self.decoder.layers), 2, num_beams, self.num_heads, max_seq_len, self.head_dim)
+        self.register_buffer("kv_cache", torch.zeros(cache_shape, dtype=torch.float16))
+
+    def _split_heads(self, states):
+        return states.view(states.shape[0], states.shape[1], self.num_heads, self.head_dim).transpose(1, 2)
+
+    def forward(self, input_ids, position, beam_idx, encoder_hidden_states):
+        num_beams = input_ids.shape[0]
+        positions = torch.arange(self.max_seq_len)
+        write_slot = (positions == position).view(1, 1, -1, 1)
+        causal_mask = torch.where(positions <= position, 0.0, MASK_VALUE).view(1, 1, 1, -1)
+
+        cache = self.kv_cache.index_select(2, beam_idx)
+        new_cache = []
+
+        hidden_states = self.decoder.embed_tokens(input_ids)
+        hidden_states = hidden_states + self.decoder.embed_positions(input_ids, position_ids=position)
+        hidden_states = self.decoder.layernorm_embedding(hidden_states)
+
+        for i, layer in enumerate(self.decoder.layers):
+            # Self-attention over the cached prefix plus this token
+            attn = layer.self_attn
+            residual = hidden_states
+            hidden_states = layer.self_attn_layer_norm(hidden_states)
+            query = self._split_heads(attn.q_proj(hidden_states))
+            keys = torch.where(write_slot, self._split_heads(attn.k_proj(hidden_states)), cache[i, 0])
+            values = torch.where(write_slot, self._split_heads(attn.v_proj(hidden_states)), cache[i, 1])
+            new_cache.append(torch.stack([keys, values]))
+            hidden_states, _ = fp16_safe_attention(attn, query, keys, values, causal_mask, scaling=attn.scaling)
+            hidden_states = residual + attn.out_proj(hidden_states.reshape(num_beams, 1, -1))
+
+            # Cross-attention over the encoder output (shared by all beams)
+            attn = layer.encoder_attn
+            residual = hidden_states
+            hidden_states = layer.encoder_attn_layer_norm(hidden_states)
+            query = self._split_heads(attn.q_proj(hidden_states))
+            keys = self._split_heads(attn.k_proj(encoder_hidden_states))
+            values = self._split_heads(attn.v_proj(encoder_hidden_states))
+            hidden_states, _ = fp16_safe_attention(attn, query, keys, values, None, scaling=attn.scaling)
+            hidden_states = residual + attn.out_proj(hidden_states.reshape(num_beams, 1, -1))
+
+            residual = hidden_states
+            hidden_states = layer.final_layer_norm(hidden_states)
+            hidden_states = layer.fc2(layer.activation_fn(layer.fc1(hidden_states)))
+            hidden_states = residual + hidden_states
+
+        self.kv_cache.copy_(torch.stack(new_cache))
+
+        hidden_states = self.decoder.layer_norm(hidden_states)
+        return self.lm_head(hidden_states)[:, 0]
+
+
+class BeamStepWrapper(StatefulDecoderWrapper):
+    """Decoder step returning only the top-k log-probabilities and tokens of each beam."""
+
+    def forward(self, input_ids, position, beam_idx, encoder_hidden_states):
+        logits = super().forward(input_ids, position, beam_idx, encoder_hidden_states)
+        log_probs = nn.functional.log_softmax(logits, dim=-1)
+        return torch.topk(log_probs, k=BEAM_CANDIDATES, dim=-1)
+
+
 def load_model():
     """Load the FormulaNet model."""
     print("Loading model from", MODEL_DIR)
@@ -104,6 +271,28 @@ def load_model():
     return model
 
 
+def compress_decoder(mlmodel, nbits: int, quantize_int8: bool = False):
+    """
+    Compress the decoder weights, either by clustering them into a 2^nbits
+    entry lookup table (0 disables) or by int8 linear quantization.
+
+    The two are alternatives: quantize_int8 takes precedence over nbits.
+    """
+    if quantize_int8:
+        print("Quantizing weights to int8...")
+        config = OptimizationConfig(
+            global_config=OpLinearQuantizerConfig(mode="linear_symmetric", dtype="int8")
+        )
+        return linear_quantize_weights(mlmodel, config)
+
+    if not nbits:
+        return mlmodel
+
+    print(f"Palettizing weights to {nbits} bits...")
+    config = OptimizationConfig(global_config=OpPalettizerConfig(mode="kmeans", nbits=nbits))
+    return palettize_weights(mlmodel, config)
+
+
 def export_encoder(model, output_dir: Path):
     """Export encoder to CoreML using torch.jit.trace."""
     print("\n=== Exporting Encoder ===")
@@ -111,7 +300,7 @@ def export_encoder(model, output_dir: Path):
     encoder_wrapper = EncoderWrapper(model.encoder, model.enc_to_dec_proj)
     encoder_wrapper.eval()
 
-    dummy_input = torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+    dummy_input = torch.randn(1, 1, IMAGE_SIZE, IMAGE_SIZE)
 
     print("Tracing encoder...")
     with torch.no_grad():
@@ -120,16 +309,24 @@ def export_encoder(model, output_dir: Path):
     print("Converting to CoreML...")
     encoder_mlmodel = ct.convert(
         traced_encoder,
+        # Takes the 8-bit grayscale image directly; the scale and bias fuse
+        # (pixel / 255 - IMAGE_MEAN) / IMAGE_STD into the model.
         inputs=[
-            ct.TensorType(
+            ct.ImageType(
                 name="pixel_values",
-                shape=(1, 3, IMAGE_SIZE, IMAGE_SIZE),
-                dtype=np.float32,
+                shape=(1, 1, IMAGE_SIZE, IMAGE_SIZE),
+                scale=1.0 / (255.0 * IMAGE_STD),
+                bias=-IMAGE_MEAN / IMAGE_STD,
+                color_layout=ct.colorlayout.GRAYSCALE,
             )
         ],
         outputs=[ct.TensorType(name="encoder_output", dtype=np.float32)],
         compute_units=ct.ComputeUnit.ALL,
-        compute_precision=ct.precision.FLOAT32,
+        # FLOAT16 lets the encoder stay on the Neural Engine; only the stem
+        # conv, which sees the full-range input, is kept in FLOAT32.
+        compute_precision=ct.transform.FP16ComputePrecision(
+            op_selector=lambda op: not is_stem_conv(op)
+        ),
         minimum_deployment_target=ct.target.macOS14,
     )
 
@@ -140,8 +337,10 @@ def export_encoder(model, output_dir: Path):
     return encoder_mlmodel
 
 
-def export_decoder(model, output_dir: Path, max_seq_len: int = 512):
-    """Export decoder to CoreML using torch.export for dynamic shapes."""
+def export_decoder(
+    model, output_dir: Path, max_seq_len: int = 512, palettize_bits: int = 0, quantize_int8: bool = False
+):
+    """Export decoder to CoreML with enumerated input_ids lengths."""
     print("\n=== Exporting Decoder ===")
 
     decoder_wrapper = DecoderWrapper(model.decoder)
@@ -154,7 +353,8 @@ def export_decoder(model, output_dir: Path, max_seq_len: int = 512):
     print("Exporting decoder with torch.export...")
     seq_dim = Dim("sequence_length", min=1, max=max_seq_len)
 
-    with torch.no_grad():
+    # Only the exported graph uses the float16-safe attention
+    with torch.no_grad(), attn_implementation(model.decoder, "fp16_safe"):
         exported = export(
             decoder_wrapper,
             (dummy_input_ids, dummy_encoder_output),
@@ -168,15 +368,28 @@ def export_decoder(model, output_dir: Path, max_seq_len: int = 512):
     exported = exported.run_decompositions({})
 
     print("Converting to CoreML...")
-    # IMPORTANT: Use FLOAT32 precision to avoid overflow in attention mask
-    # The causal attention mask uses very large negative values that overflow
-    # when cast to float16, causing NaN outputs.
+    # Enumerate the sequence lengths rather than keeping the flexible Dim:
+    # flexible shapes are not run on the Neural Engine.
+    seq_shapes = ct.EnumeratedShapes(
+        shapes=[(1, seq_len) for seq_len in DECODER_SEQ_LENS if seq_len <= max_seq_len],
+        default=(1, 1),
+    )
+    # Run in FLOAT16 except for the mask add feeding each softmax. The
+    # attention pre-scales q and clamps the mask to stay in float16 range,
+    # which previously overflowed to NaN and forced the decoder to FLOAT32.
     decoder_mlmodel = ct.convert(
         exported,
+        inputs=[
+            ct.TensorType(name="input_ids", shape=seq_shapes, dtype=np.int32),
+            ct.TensorType(name="encoder_hidden_states", shape=(1, ENC_SEQ_LEN, 384), dtype=np.float32),
+        ],
         compute_units=ct.ComputeUnit.ALL,
-        compute_precision=ct.precision.FLOAT32,
+        compute_precision=ct.transform.FP16ComputePrecision(
+            op_selector=lambda op: not is_mask_add(op)
+        ),
         minimum_deployment_target=ct.target.macOS14,
     )
+    decoder_mlmodel = compress_decoder(decoder_mlmodel, palettize_bits, quantize_int8)
 
     decoder_path = output_dir / "Decoder.mlpackage"
     print(f"Saving to {decoder_path}")
@@ -185,54 +398,169 @@ def export_decoder(model, output_dir: Path, max_seq_len: int = 512):
     return decoder_mlmodel
 
 
+def convert_stateful_step(step_wrapper, outputs):
+    """Trace a stateful decoder step wrapper and convert it to CoreML."""
+    step_wrapper.eval()
+
+    dummy_input_ids = torch.zeros((NUM_BEAMS, 1), dtype=torch.long)
+    dummy_position = torch.zeros((1,), dtype=torch.long)
+    dummy_beam_idx = torch.arange(NUM_BEAMS)
+    dummy_encoder_output = torch.randn(1, ENC_SEQ_LEN, 384)
+
+    print("Tracing decoder step...")
+    with torch.no_grad():
+        traced_step = torch.jit.trace(
+            step_wrapper, (dummy_input_ids, dummy_position, dummy_beam_idx, dummy_encoder_output)
+        )
+
+    print("Converting to CoreML...")
+    # States require macOS 15, so the app keeps using the full-prefix
+    # Decoder.mlpackage on macOS 14.
+    return ct.convert(
+        traced_step,
+        inputs=[
+            ct.TensorType(name="input_ids", shape=(NUM_BEAMS, 1), dtype=np.int32),
+            ct.TensorType(name="position", shape=(1,), dtype=np.int32),
+            ct.TensorType(name="beam_idx", shape=(NUM_BEAMS,), dtype=np.int32),
+            ct.TensorType(name="encoder_hidden_states", shape=(1, ENC_SEQ_LEN, 384), dtype=np.float32),
+        ],
+        outputs=outputs,
+        states=[
+            ct.StateType(
+                wrapped_type=ct.TensorType(shape=step_wrapper.kv_cache.shape, dtype=np.float16),
+                name="kv_cache",
+            )
+        ],
+        compute_units=ct.ComputeUnit.ALL,
+        compute_precision=ct.transform.FP16ComputePrecision(
+            op_selector=lambda op: not is_mask_add(op)
+        ),
+        minimum_deployment_target=ct.target.macOS15,
+    )
+
+
+def convert_decoder_step(model, palettize_bits: int = 0, quantize_int8: bool = False):
+    """
+    Convert the stateful single-token decoder step to CoreML.
+
+    Only used by --validate: its logits check the KV-cache reorder that
+    beam_step shares, so it is neither saved nor bundled.
+    """
+    print("\n=== Converting Decoder Step (stateful KV-cache, validation only) ===")
+
+    step_mlmodel = convert_stateful_step(
+        StatefulDecoderWrapper(model.decoder),
+        outputs=[ct.TensorType(name="logits", dtype=np.float32)],
+    )
+    return compress_decoder(step_mlmodel, palettize_bits, quantize_int8)
+
+
+def export_beam_step(model, output_dir: Path, palettize_bits: int = 0, quantize_int8: bool = False):
+    """Export the stateful decoder step with top-k candidate selection to CoreML."""
+    print("\n=== Exporting Beam Step ===")
+
+    beam_mlmodel = convert_stateful_step(
+        BeamStepWrapper(model.decoder),
+        outputs=[
+            ct.TensorType(name="log_probs", dtype=np.float32),
+            ct.TensorType(name="token_ids", dtype=np.int32),
+        ],
+    )
+    beam_mlmodel = compress_decoder(beam_mlmodel, palettize_bits, quantize_int8)
+
+    beam_path = output_dir / "BeamStep.mlpackage"
+    print(f"Saving to {beam_path}")
+    beam_mlmodel.save(str(beam_path))
+
+    return beam_mlmodel
+
+
+def export_multifunction(output_dir: Path):
+    """Bundle the encoder and beam step into one multi-function model."""
+    print("\n=== Exporting Multi-function Model ===")
+
+    desc = ct.utils.MultiFunctionDescriptor()
+    desc.add_function(str(output_dir / "Encoder.mlpackage"), "main", "encoder")
+    desc.add_function(str(output_dir / "BeamStep.mlpackage"), "main", "beam_step")
+    desc.default_function_name = "encoder"
+
+    bundle_path = output_dir / "FormulaNet.mlpackage"
+    print(f"Saving to {bundle_path}")
+    ct.utils.save_multifunction(desc, str(bundle_path))
+
+
 def export_vocab(output_dir: Path):
-    """Export vocabulary for Swift tokenizer."""
+    """
+    Export vocabulary for Swift tokenizer.
+
+    tokenizer.json is shipped as is, alongside special_tokens.json and a
+    packed vocab.bin the app reads without JSON parsing. vocab.bin layout
+    (little-endian): u32 count, u32 offsets[count], then the UTF-8 token
+    bytes; token i spans offsets[i] up to offsets[i + 1] (or the end).
+    """
     print("\n=== Exporting Vocabulary ===")
 
     tokenizer_path = MODEL_DIR / "tokenizer.json"
-    with open(tokenizer_path, "r") as f:
-        tokenizer_data = json.load(f)
-
-    vocab = tokenizer_data["model"]["vocab"]
-    reverse_vocab = {str(v): k for k, v in vocab.items()}
-
-    vocab_data = {
-        "vocab": vocab,
-        "reverse_vocab": reverse_vocab,
-        "special_tokens": {
-            "bos_token_id": 0,
-            "pad_token_id": 1,
-            "eos_token_id": 2,
-            "unk_token_id": 3,
-        },
-        "vocab_size": len(vocab),
+    shutil.copy(tokenizer_path, output_dir / "tokenizer.json")
+
+    special_tokens = {
+        "bos_token_id": 0,
+        "pad_token_id": 1,
+        "eos_token_id": 2,
+        "unk_token_id": 3,
     }
+    with open(output_dir / "special_tokens.json", "w") as f:
+        json.dump(special_tokens, f, indent=2)
+
+    with open(tokenizer_path, "r") as f:
+        vocab = json.load(f)["model"]["vocab"]
 
-    vocab_path = output_dir / "vocab.json"
-    print(f"Saving vocabulary ({len(vocab)} tokens) to {vocab_path}")
-    with open(vocab_path, "w") as f:
-        json.dump(vocab_data, f, indent=2, ensure_ascii=False)
+    # WordLevel ids are contiguous, so the table is indexed by token id
+    tokens = [b""] * len(vocab)
+    for token, token_id in vocab.items():
+        tokens[token_id] = token.encode("utf-8")
 
-    return vocab_data
+    offsets = []
+    offset = 0
+    for token in tokens:
+        offsets.append(offset)
+        offset += len(token)
+
+    vocab_path = output_dir / "vocab.bin"
+    print(f"Saving vocabulary ({len(tokens)} tokens) to {vocab_path}")
+    with open(vocab_path, "wb") as f:
+        f.write(struct.pack(f"<I{len(offsets)}I", len(tokens), *offsets))
+        f.write(b"".join(tokens))
+
+    return vocab
 
 
 def validate_encoder(encoder_mlmodel, model):
     """Validate encoder CoreML output matches PyTorch."""
     print("\n=== Validating Encoder ===")
 
-    test_input = torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+    test_pixels = np.random.randint(0, 256, size=(IMAGE_SIZE, IMAGE_SIZE), dtype=np.uint8)
+    test_image = Image.fromarray(test_pixels)
+    test_input = torch.from_numpy((test_pixels / 255.0 - IMAGE_MEAN) / IMAGE_STD).float()[None, None]
 
     with torch.no_grad():
         encoder_wrapper = EncoderWrapper(model.encoder, model.enc_to_dec_proj)
         pytorch_output = encoder_wrapper(test_input).numpy()
 
-    coreml_output = encoder_mlmodel.predict({"pixel_values": test_input.numpy()})[
-        "encoder_output"
-    ]
+    coreml_output = encoder_mlmodel.predict({"pixel_values": test_image})["encoder_output"]
 
+    # A CPU-only handle separates conversion error from the numerical drift
+    # of the Neural Engine / GPU backends
+    cpu_mlmodel = ct.models.MLModel(encoder_mlmodel.package_path, compute_units=ct.ComputeUnit.CPU_ONLY)
+    cpu_output = cpu_mlmodel.predict({"pixel_values": test_image})["encoder_output"]
+
+    conversion_diff = np.abs(pytorch_output - cpu_output).max()
+    device_diff = np.abs(cpu_output - coreml_output).max()
     max_diff = np.abs(pytorch_output - coreml_output).max()
     mean_diff = np.abs(pytorch_output - coreml_output).mean()
 
+    print(f"  Conversion max difference (CPU only vs PyTorch): {conversion_diff:.6f}")
+    print(f"  ANE/GPU max difference (all units vs CPU only): {device_diff:.6f}")
     print(f"  Max difference: {max_diff:.6f}")
     print(f"  Mean difference: {mean_diff:.6f}")
 
@@ -250,19 +578,87 @@ def validate_decoder(decoder_mlmodel, model):
 
     test_input_ids = torch.tensor([[0, 129, 11, 150]], dtype=torch.long)
     test_encoder_output = torch.randn(1, ENC_SEQ_LEN, 384)
+    seq_len = test_input_ids.shape[1]
 
     with torch.no_grad():
         decoder_wrapper = DecoderWrapper(model.decoder)
         pytorch_output = decoder_wrapper(test_input_ids, test_encoder_output).numpy()
 
+    # Pad to the next enumerated length like the app does; the decoder is
+    # causal, so the padding does not change the logits of earlier positions.
+    padded_len = next(n for n in DECODER_SEQ_LENS if n >= seq_len)
+    padded_input_ids = np.full((1, padded_len), PAD_TOKEN_ID, dtype=np.int32)
+    padded_input_ids[:, :seq_len] = test_input_ids.numpy()
+
     # Find the output key (may vary)
     coreml_result = decoder_mlmodel.predict({
-        "input_ids": test_input_ids.numpy().astype(np.int32),
+        "input_ids": padded_input_ids,
         "encoder_hidden_states": test_encoder_output.numpy(),
     })
 
     # Get the logits output (key name may vary)
-    coreml_output = list(coreml_result.values())[0]
+    coreml_output = list(coreml_result.values())[0][:, :seq_len]
+
+    max_diff = np.abs(pytorch_output - coreml_output).max()
+    mean_diff = np.abs(pytorch_output - coreml_output).mean()
+    has_nan = np.isnan(coreml_output).any()
+
+    print(f"  Max difference: {max_diff:.6f}")
+    print(f"  Mean difference: {mean_diff:.6f}")
+    print(f"  Has NaN: {has_nan}")
+
+    if not has_nan and max_diff < 0.5:
+        print("  Validation PASSED")
+        return True
+    else:
+        print("  Validation FAILED")
+        return False
+
+
+# (token fed to each row, row of the previous step each row continues) per
+# step; distinct prefixes and non-identity beam_idx exercise the cache reorder
+STEP_SCHEDULE = [
+    ([0, 0, 0, 0], [0, 1, 2, 3]),
+    ([129, 11, 150, 42], [0, 1, 2, 3]),
+    ([7, 8, 9, 10], [1, 1, 0, 3]),
+    ([31, 32, 33, 34], [2, 0, 3, 1]),
+]
+
+
+def run_step_schedule(step_mlmodel, encoder_output: np.ndarray):
+    """Run STEP_SCHEDULE through a stateful step model, returning the last outputs and each row's prefix."""
+    state = step_mlmodel.make_state()
+    prefixes = [[] for _ in range(NUM_BEAMS)]
+    for position, (token_ids, beam_idx) in enumerate(STEP_SCHEDULE):
+        coreml_result = step_mlmodel.predict({
+            "input_ids": np.array(token_ids, dtype=np.int32).reshape(NUM_BEAMS, 1),
+            "position": np.array([position], dtype=np.int32),
+            "beam_idx": np.array(beam_idx, dtype=np.int32),
+            "encoder_hidden_states": encoder_output,
+        }, state=state)
+        prefixes = [prefixes[row] + [token_id] for row, token_id in zip(beam_idx, token_ids)]
+    return coreml_result, prefixes
+
+
+def reference_logits(model, prefixes, encoder_output: torch.Tensor) -> np.ndarray:
+    """Last-position PyTorch logits of each prefix, recomputed from the full prefix."""
+    with torch.no_grad():
+        decoder_wrapper = DecoderWrapper(model.decoder)
+        return np.stack([
+            decoder_wrapper(torch.tensor([prefix], dtype=torch.long), encoder_output)[0, -1].numpy()
+            for prefix in prefixes
+        ])
+
+
+def validate_decoder_step(step_mlmodel, model):
+    """Validate stateful decoder steps reproduce the full-prefix PyTorch logits of every beam."""
+    print("\n=== Validating Decoder Step ===")
+
+    test_encoder_output = torch.randn(1, ENC_SEQ_LEN, 384)
+
+    coreml_result, prefixes = run_step_schedule(step_mlmodel, test_encoder_output.numpy())
+    coreml_output = coreml_result["logits"]
+    pytorch_output = reference_logits(model, prefixes, test_encoder_output)
 
     max_diff = np.abs(pytorch_output - coreml_output).max()
     mean_diff = np.abs(pytorch_output - coreml_output).mean()
@@ -280,6 +676,40 @@ def validate_decoder(decoder_mlmodel, model):
         return False
 
 
+def validate_beam_step(beam_mlmodel, model):
+    """Validate the beam step's top-k candidates against the full-prefix PyTorch log-probabilities."""
+    print("\n=== Validating Beam Step ===")
+
+    test_encoder_output = torch.randn(1, ENC_SEQ_LEN, 384)
+
+    coreml_result, prefixes = run_step_schedule(beam_mlmodel, test_encoder_output.numpy())
+    log_probs = coreml_result["log_probs"]
+    token_ids = coreml_result["token_ids"].astype(np.int64)
+
+    pytorch_log_probs = torch.log_softmax(
+        torch.from_numpy(reference_logits(model, prefixes, test_encoder_output)), dim=-1
+    )
+    pytorch_top_k = torch.topk(pytorch_log_probs, k=token_ids.shape[1], dim=-1).values.numpy()
+    pytorch_log_probs = pytorch_log_probs.numpy()
+
+    # Near-ties may swap tokens in float16, so compare the top-k values, and
+    # score the returned tokens with the PyTorch log-probabilities
+    values_diff = np.abs(pytorch_top_k - log_probs).max()
+    tokens_diff = np.abs(np.take_along_axis(pytorch_log_probs, token_ids, axis=-1) - log_probs).max()
+    has_nan = np.isnan(log_probs).any()
+
+    print(f"  Top-k log-probability max difference: {values_diff:.6f}")
+    print(f"  Returned token log-probability max difference: {tokens_diff:.6f}")
+    print(f"  Has NaN: {has_nan}")
+
+    if not has_nan and max(values_diff, tokens_diff) < 0.5:
+        print("  Validation PASSED")
+        return True
+    else:
+        print("  Validation FAILED")
+        return False
+
+
 def main():
     parser = argparse.ArgumentParser(description="Export FormulaNet to CoreML")
     parser.add_argument(
@@ -293,6 +723,18 @@ def main():
         action="store_true",
         help="Validate CoreML output against PyTorch",
     )
+    parser.add_argument(
+        "--palettize-bits",
+        type=int,
+        default=6,
+        choices=[0, 1, 2, 3, 4, 6, 8],
+        help="Palettize decoder weights to this many bits with k-means (0 disables)",
+    )
+    parser.add_argument(
+        "--quantize-int8",
+        action="store_true",
+        help="Quantize decoder weights to int8 instead of palettizing them",
+    )
     args = parser.parse_args()
 
     output_dir = args.output_dir
@@ -307,13 +749,24 @@ def main():
 
     # Export components
     encoder_mlmodel = export_encoder(model, output_dir)
-    decoder_mlmodel = export_decoder(model, output_dir)
+    decoder_mlmodel = export_decoder(
+        model, output_dir, palettize_bits=args.palettize_bits, quantize_int8=args.quantize_int8
+    )
+    beam_mlmodel = export_beam_step(
+        model, output_dir, palettize_bits=args.palettize_bits, quantize_int8=args.quantize_int8
+    )
+    export_multifunction(output_dir)
     export_vocab(output_dir)
 
     # Validate
     if args.validate:
         validate_encoder(encoder_mlmodel, model)
         validate_decoder(decoder_mlmodel, model)
+        step_mlmodel = convert_decoder_step(
+            model, palettize_bits=args.palettize_bits, quantize_int8=args.quantize_int8
+        )
+        validate_decoder_step(step_mlmodel, model)
+        validate_beam_step(beam_mlmodel, model)
 
     print("\n=== Export Complete ===")
     print(f"Models saved to: {output_dir}")
@@ -12,6 +12,8 @@ Keeps the FormulaNet model loaded in memory and accepts inference requests via U
 
 import sys
 import os
+import platform
+import re
 import socket
 import signal
 from pathlib import Path
@@ -30,22 +32,58 @@ AutoModel.register(HGNetv2Config, HGNetv2)
 
 from PIL import Image
 from transformers import AutoTokenizer, VisionEncoderDecoderModel
+from transformers.modeling_outputs import BaseModelOutput
 from texo.data.processor.image_processor import EvalMERImageProcessor
+import numpy as np
 import torch
 
+# coremltools is optional: without it the model runs in PyTorch
+try:
+    import coremltools as ct
+except ImportError:
+    ct = None
+
 
 MODEL_DIR = BACKEND_DIR / "model_cache" / "FormulaNet"
+# Exported by backends/texo-coreml/export_coreml.py and copied here by setup.sh
+FORMULANET_MLPACKAGE = BACKEND_DIR / "FormulaNet.mlpackage"
+ENCODER_MLPACKAGE = BACKEND_DIR / "Encoder.mlpackage"
 SOCKET_PATH = "/tmp/mathsnip_texo.sock"
 PID_FILE = "/tmp/mathsnip_texo.pid"
 
+IMAGE_SIZE = 384
+# EvalMERImageProcessor normalization, fused into the CoreML encoder input
+IMAGE_MEAN = 0.7931
+IMAGE_STD = 0.1738
+
+# Generation parameters (NUM_BEAMS is baked into the exported beam_step)
+MAX_LENGTH = 512
+NUM_BEAMS = 4
+BOS_TOKEN_ID = 0
+EOS_TOKEN_ID = 2
+
+# format_latex patterns; tokens are separated by single spaces after _WHITESPACE_RE
+_WHITESPACE_RE = re.compile(r'\s+')
+_LINE_BREAK_RE = re.compile(r'(?<![^ ])\\\\ ')
+_TOKEN_GAP_RE = re.compile(r'(?<![^ \n])(\\[^ \n]* (?=[^\W_]))| ')
+
+# Escaped characters are matched first so \{ and \} do not count as braces
+_BRACE_RE = re.compile(r'\\.|[{}]')
+
 
 def load_model():
-    """Load the FormulaNet model and tokenizer."""
+    """Load the FormulaNet model and tokenizer, preferring the CoreML pipeline."""
     print("Loading model...", file=sys.stderr, flush=True)
 
-    model = VisionEncoderDecoderModel.from_pretrained(str(MODEL_DIR))
     tokenizer = AutoTokenizer.from_pretrained(str(MODEL_DIR))
-    image_processor = EvalMERImageProcessor(image_size={'height': 384, 'width': 384})
+    image_processor = EvalMERImageProcessor(image_size={'height': IMAGE_SIZE, 'width': IMAGE_SIZE})
+
+    coreml_models = load_coreml_models()
+    if uses_beam_step(coreml_models):
+        print("Model loaded with CoreML", file=sys.stderr, flush=True)
+        return None, tokenizer, image_processor, None, coreml_models
+
+    model = VisionEncoderDecoderModel.from_pretrained(str(MODEL_DIR))
 
     # Use MPS if available (Apple Silicon), otherwise CPU
     if torch.backends.mps.is_available():
@@ -53,20 +91,115 @@ def load_model():
     else:
         device = torch.device("cpu")
 
+    if coreml_models is not None:
+        # The CoreML encoder already applies enc_to_dec_proj, so the PyTorch
+        # model must not project the encoder outputs a second time.
+        model.enc_to_dec_proj = torch.nn.Identity()
+        print("Encoder loaded with CoreML, decoder runs in PyTorch", file=sys.stderr, flush=True)
+
     model = model.to(device)
     model.eval()
 
-    # Compile model for faster inference (PyTorch 2.0+)
-    # Use reduce-overhead mode for repeated inference on similar inputs
+    # Compile the encoder and decoder separately for faster inference (PyTorch 2.0+).
+    # reduce-overhead relies on CUDA graphs, which MPS does not have. The encoder
+    # always sees one 384x384 image, so its shapes are static. The decoder's KV
+    # cache grows every step and greedy and beam search use different batch
+    # sizes, so it is compiled with dynamic shapes instead of recompiling per step.
     print("Compiling model with torch.compile...", file=sys.stderr, flush=True)
     try:
-        model = torch.compile(model, mode="reduce-overhead")
+        model.encoder = torch.compile(model.encoder, dynamic=False, fullgraph=False)
+        model.decoder = torch.compile(model.decoder, dynamic=True, fullgraph=False)
         print("Model compiled successfully", file=sys.stderr, flush=True)
     except Exception as e:
         print(f"torch.compile failed (will use eager mode): {e}", file=sys.stderr, flush=True)
 
     print(f"Model loaded on {device}", file=sys.stderr, flush=True)
-    return model, tokenizer, image_processor, device
+    print(
+        f"Decoding greedily; beam search (num_beams={NUM_BEAMS}) is only rerun when the "
+        "output has unbalanced braces, trading some accuracy for ~4x less decoder work",
+        file=sys.stderr, flush=True,
+    )
+    return model, tokenizer, image_processor, device, coreml_models
+
+
+def macos_major_version() -> int:
+    """Major macOS version, or 0 when not running on macOS."""
+    version = platform.mac_ver()[0]
+    return int(version.split(".")[0]) if version else 0
+
+
+def load_coreml_models():
+    """
+    Load the CoreML models, or None if unavailable.
+
+    The encoder and beam_step functions of FormulaNet.mlpackage need macOS 15
+    for the stateful KV-cache. On macOS 14 only Encoder.mlpackage is loaded
+    and the decoder stays in PyTorch.
+    """
+    if ct is None:
+        return None
+
+    try:
+        if FORMULANET_MLPACKAGE.exists() and macos_major_version() >= 15:
+            return {
+                name: ct.models.MLModel(
+                    str(FORMULANET_MLPACKAGE), compute_units=ct.ComputeUnit.ALL, function_name=name
+                )
+                for name in ("encoder", "beam_step")
+            }
+        if ENCODER_MLPACKAGE.exists():
+            return {"encoder": ct.models.MLModel(str(ENCODER_MLPACKAGE), compute_units=ct.ComputeUnit.ALL)}
+    except Exception as e:
+        print(f"CoreML model failed to load (will use PyTorch): {e}", file=sys.stderr, flush=True)
+    return None
+
+
+def uses_beam_step(coreml_models) -> bool:
+    """Whether the whole model, decoder included, runs in CoreML."""
+    return coreml_models is not None and "beam_step" in coreml_models
+
+
+def warmup_coreml_models(coreml_models):
+    """
+    Run every CoreML function once with dummy inputs.
+
+    The first prediction of each model pays the Neural Engine request
+    preparation, so doing it here keeps that stall out of the first request.
+    """
+    encoder_output = coreml_models["encoder"].predict({
+        "pixel_values": Image.new("L", (IMAGE_SIZE, IMAGE_SIZE), color=255),
+    })["encoder_output"]
+
+    if not uses_beam_step(coreml_models):
+        return
+
+    beam_step = coreml_models["beam_step"]
+    beam_step.predict({
+        "input_ids": np.full((NUM_BEAMS, 1), BOS_TOKEN_ID, dtype=np.int32),
+        "position": np.zeros((1,), dtype=np.int32),
+        "beam_idx": np.arange(NUM_BEAMS, dtype=np.int32),
+        "encoder_hidden_states": encoder_output,
+    }, state=beam_step.make_state())
+
+
+def allocate_pixel_buffers(device):
+    """
+    Preallocate the (staging, device) pixel tensors reused by every request.
+
+    Copying each request into the same device tensor avoids an MPS
+    allocation per request; the staging tensor is pinned when supported so
+    the host to device copy can be asynchronous.
+    """
+    shape = (1, 3, IMAGE_SIZE, IMAGE_SIZE)
+    if device.type == "cpu":
+        pixel_buffer = torch.empty(shape, dtype=torch.float32)
+        return pixel_buffer, pixel_buffer
+
+    try:
+        staging = torch.empty(shape, dtype=torch.float32, pin_memory=True)
+    except RuntimeError:
+        staging = torch.empty(shape, dtype=torch.float32)
+    return staging, torch.empty(shape, dtype=torch.float32, device=device)
 
 
 def format_latex(latex: str) -> str:
@@ -79,49 +212,187 @@ def format_latex(latex: str) -> str:
     - Only add space after LaTeX commands (starting with \) when followed by alphanumeric
     - Add newline after \\
     """
-    if not latex:
-        return ""
+    latex = _WHITESPACE_RE.sub(' ', latex.strip())
 
-    # Split by whitespace to get tokens
-    tokens = latex.split()
-    if not tokens:
-        return ""
+    # Newline after \\ tokens, then drop every gap except command + alphanumeric
+    latex = _LINE_BREAK_RE.sub(r'\\\\\n', latex)
+    return _TOKEN_GAP_RE.sub(r'\1', latex)
 
-    new_tokens = []
-    for i in range(len(tokens) - 1):
-        token = tokens[i]
-        next_token = tokens[i + 1]
-        new_tokens.append(token)
 
-        if token == '\\\\':
-            # Add newline after line break
-            new_tokens.append('\n')
-        elif token.startswith('\\') and next_token and next_token[0].isalnum():
-            # Add space after LaTeX command if followed by alphanumeric
-            new_tokens.append(' ')
+def beam_search(encoder_output: np.ndarray, beam_step, max_length: int = MAX_LENGTH) -> list:
+    """
+    Beam search over the CoreML beam_step function, one call per token for all beams.
 
-    # Add the last token
-    new_tokens.append(tokens[-1])
+    The KV-cache lives in the model state; beam_idx tells the model which row
+    of the previous step each beam continues, so it can reorder the cache.
+    """
+    state = beam_step.make_state()
+    beams = [([BOS_TOKEN_ID], 0.0)]  # (tokens, summed log-probability)
+    finished = []
+
+    # Input arrays are allocated once and updated in place every step
+    input_ids = np.full((NUM_BEAMS, 1), BOS_TOKEN_ID, dtype=np.int32)
+    position = np.zeros((1,), dtype=np.int32)
+    beam_idx = np.zeros(NUM_BEAMS, dtype=np.int32)
+    inputs = {
+        "input_ids": input_ids,
+        "position": position,
+        "beam_idx": beam_idx,
+        "encoder_hidden_states": encoder_output,
+    }
+
+    for step in range(max_length - 1):
+        position[0] = step
+        outputs = beam_step.predict(inputs, state=state)
+        log_probs = outputs["log_probs"].tolist()
+        token_ids = outputs["token_ids"].tolist()
+
+        # Extend each live beam with its top-k tokens, best candidates first
+        candidates = sorted(
+            (
+                (score + log_prob, row, token_id)
+                for row, (_, score) in enumerate(beams)
+                for log_prob, token_id in zip(log_probs[row], token_ids[row])
+            ),
+            reverse=True,
+        )
 
-    return ''.join(new_tokens)
+        next_beams = []
+        next_rows = []
+        for rank, (score, row, token_id) in enumerate(candidates):
+            tokens = beams[row][0] + [token_id]
+            if token_id == EOS_TOKEN_ID:
+                # Like HF generate, only EOS among the NUM_BEAMS best candidates finishes a hypothesis
+                if rank < NUM_BEAMS:
+                    finished.append((tokens, score))
+            else:
+                next_beams.append((tokens, score))
+                next_rows.append(row)
+            if len(next_beams) == NUM_BEAMS:
+                break
+
+        if len(finished) >= NUM_BEAMS or not next_beams:
+            break
+
+        # Rows past the live beams repeat the first one and are ignored
+        beams = next_beams
+        padding = NUM_BEAMS - len(beams)
+        beam_idx[:] = next_rows + next_rows[:1] * padding
+        last_tokens = [tokens[-1] for tokens, _ in beams]
+        input_ids[:, 0] = last_tokens + last_tokens[:1] * padding
+
+    # Highest length-normalized score, preferring completed hypotheses
+    tokens, _ = max(finished or beams, key=lambda beam: beam[1] / len(beam[0]))
+    return tokens
+
+
+def encoder_image(pixel_values: torch.Tensor) -> Image.Image:
+    """
+    Undo the processor normalization to get the 8-bit grayscale image the
+    CoreML encoder takes, so CoreML sees the same preprocessing as PyTorch.
+    """
+    gray = pixel_values[0].numpy() * IMAGE_STD + IMAGE_MEAN
+    return Image.fromarray(np.clip(np.rint(gray * 255), 0, 255).astype(np.uint8))
 
 
-def inference(image_path: str, model, tokenizer, image_processor, device) -> str:
-    """Run inference on an image and return LaTeX string."""
-    image = Image.open(image_path).convert("RGB")
+def preprocess(image: Image.Image, image_processor, coreml_models, pixel_buffers=None):
+    """Build the encoder input: a grayscale image for CoreML, pixel values for PyTorch."""
+    if image.mode != "RGB":
+        image = image.convert("RGB")
 
     # Process image using Texo's processor (returns tensor directly)
-    pixel_values = image_processor(image).unsqueeze(0).to(device)
+    pixel_values = image_processor(image)
+    if coreml_models is not None:
+        return encoder_image(pixel_values)
+
+    pixel_values = pixel_values.unsqueeze(0)
+    if pixel_buffers is not None:
+        staging, pixel_buffer = pixel_buffers
+        staging.copy_(pixel_values)
+        pixel_values = pixel_buffer.copy_(staging, non_blocking=True)
+    return pixel_values
+
+
+def braces_balanced(latex: str) -> bool:
+    """Cheap LaTeX validity check: every unescaped { is closed by a matching }."""
+    depth = 0
+    for match in _BRACE_RE.finditer(latex):
+        if match.group() == "{":
+            depth += 1
+        elif match.group() == "}":
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+
+def encode(encoder_input, model, device, coreml_models):
+    """
+    Run the encoder once on an input built by preprocess().
+
+    Returns a NumPy array for the CoreML beam_step and a tensor on device for
+    the PyTorch decoder, so greedy decoding and its beam search retry share
+    one encoder pass.
+    """
+    if coreml_models is None:
+        with torch.inference_mode():
+            return model.encoder(pixel_values=encoder_input.to(device))[0]
+
+    encoder_output = coreml_models["encoder"].predict(
+        {"pixel_values": encoder_input}
+    )["encoder_output"]
+    if uses_beam_step(coreml_models):
+        return encoder_output
+    return torch.from_numpy(encoder_output).to(device)
+
+
+def generate(
+    encoder_output,
+    model,
+    coreml_models,
+    max_length: int = MAX_LENGTH,
+    num_beams: int = NUM_BEAMS,
+) -> list:
+    """
+    Generate token ids for an encoder output returned by encode().
 
-    with torch.no_grad():
+    num_beams only applies to the PyTorch decoder; the CoreML beam_step always
+    decodes NUM_BEAMS beams in one call per token.
+    """
+    if uses_beam_step(coreml_models):
+        return beam_search(encoder_output, coreml_models["beam_step"], max_length)
+
+    with torch.inference_mode():
         generated_ids = model.generate(
-            pixel_values,
-            max_length=512,
-            num_beams=4,
-            early_stopping=True
+            # A new BaseModelOutput per call, since generate expands it in place for beams
+            encoder_outputs=BaseModelOutput(last_hidden_state=encoder_output),
+            max_length=max_length,
+            num_beams=num_beams,
+            do_sample=False,
+            early_stopping=num_beams > 1,
         )
+    return generated_ids[0].tolist()
 
-    latex = tokenizer.decode(generated_ids[0], skip_special_tokens=True)
+
+def inference(image_path: str, model, tokenizer, image_processor, device, coreml_models=None, pixel_buffers=None) -> str:
+    """Run inference on an image and return LaTeX string."""
+    image = Image.open(image_path)
+    if image.format == "JPEG":
+        # Let libjpeg decode at a reduced scale, keeping at least 2x the model input
+        image.draft("RGB", (IMAGE_SIZE * 2, IMAGE_SIZE * 2))
+
+    encoder_input = preprocess(image, image_processor, coreml_models, pixel_buffers)
+    encoder_output = encode(encoder_input, model, device, coreml_models)
+
+    # Greedy decoding first on the PyTorch decoder, beam search if it looks broken
+    num_beams = NUM_BEAMS if uses_beam_step(coreml_models) else 1
+    generated_ids = generate(encoder_output, model, coreml_models, num_beams=num_beams)
+    latex = tokenizer.decode(generated_ids, skip_special_tokens=True)
+
+    if num_beams == 1 and not braces_balanced(latex):
+        print("Greedy output has unbalanced braces, retrying with beam search", file=sys.stderr, flush=True)
+        generated_ids = generate(encoder_output, model, coreml_models, num_beams=NUM_BEAMS)
+        latex = tokenizer.decode(generated_ids, skip_special_tokens=True)
 
     # Format LaTeX to remove unnecessary spaces
     latex = format_latex(latex)
@@ -162,15 +433,22 @@ def run_server():
         f.write(str(os.getpid()))
 
     # Load model once at startup
-    model, tokenizer, image_processor, device = load_model()
+    model, tokenizer, image_processor, device, coreml_models = load_model()
+    # Only used when the encoder runs in PyTorch
+    pixel_buffers = allocate_pixel_buffers(device) if device is not None and coreml_models is None else None
 
-    # Warm up the model with a dummy inference to trigger compilation
+    # Warm up the model with a dummy inference to trigger compilation of the
+    # encoder and of the (dynamic-shape) decoder for greedy and beam search.
+    # The models stay loaded for the lifetime of the server.
     print("Warming up model...", file=sys.stderr, flush=True)
     try:
-        dummy_image = Image.new('RGB', (384, 384), color='white')
-        pixel_values = image_processor(dummy_image).unsqueeze(0).to(device)
-        with torch.no_grad():
-            _ = model.generate(pixel_values, max_length=10)
+        if coreml_models is not None:
+            warmup_coreml_models(coreml_models)
+        dummy_image = Image.new('RGB', (IMAGE_SIZE, IMAGE_SIZE), color='white')
+        encoder_input = preprocess(dummy_image, image_processor, coreml_models)
+        encoder_output = encode(encoder_input, model, device, coreml_models)
+        for num_beams in ((NUM_BEAMS,) if uses_beam_step(coreml_models) else (1, NUM_BEAMS)):
+            _ = generate(encoder_output, model, coreml_models, max_length=10, num_beams=num_beams)
         print("Warmup complete", file=sys.stderr, flush=True)
     except Exception as e:
         print(f"Warmup failed: {e}", file=sys.stderr, flush=True)
@@ -180,6 +458,9 @@ def run_server():
     server.bind(SOCKET_PATH)
     server.listen(1)
 
+    # Receive buffer reused for every request
+    recv_buffer = memoryview(bytearray(4096))
+
     # Signal that we're ready
     print("READY", flush=True)
 
@@ -190,18 +471,20 @@ def run_server():
             conn, _ = server.accept()
             try:
                 # Receive image path
-                data = conn.recv(4096)
-                if not data:
+                received = conn.recv_into(recv_buffer)
+                if not received:
                     continue
 
-                image_path = data.decode('utf-8').strip()
+                image_path = str(recv_buffer[:received], 'utf-8').strip()
 
                 if not Path(image_path).exists():
                     conn.sendall(b"ERROR: Image not found")
                     continue
 
                 # Run inference
-                latex = inference(image_path, model, tokenizer, image_processor, device)
+                latex = inference(
+                    image_path, model, tokenizer, image_processor, device, coreml_models, pixel_buffers
+                )
                 conn.sendall(latex.encode('utf-8'))
 
             except Exception as e:
@@ -219,6 +502,9 @@ def run_server():
 
 def main():
     """Entry point - run as server or single inference based on args."""
+    # Inference only: skip autograd bookkeeping everywhere, not just in generate
+    torch.set_grad_enabled(False)
+
     if len(sys.argv) == 2 and sys.argv[1] == "--server":
         run_server()
     elif len(sys.argv) == 2:
@@ -227,8 +513,8 @@ def main():
         if not Path(image_path).exists():
             print(f"Error: Image not found: {image_path}", file=sys.stderr)
             sys.exit(1)
-        model, tokenizer, image_processor, device = load_model()
-        latex = inference(image_path, model, tokenizer, image_processor, device)
+        model, tokenizer, image_processor, device, coreml_models = load_model()
+        latex = inference(image_path, model, tokenizer, image_processor, device, coreml_models)
         print(latex)
     else:
         print("Usage: inference.py --server  (daemon mode)", file=sys.stderr)
@@ -73,12 +73,31 @@ uv pip install --python "$VENV_DIR/bin/python" \
     "lightning>=2.5.3" \
     "datasets==4.0.0" \
     "evaluate>=0.4.5" \
-    "rich>=10.2.2"
+    "rich>=10.2.2" \
+    "coremltools>=8.0"
 
 # Copy inference script
 echo "Installing inference script..."
 cp "$SCRIPT_DIR/inference.py" "$MATHSNIP_DIR/inference.py"
 
+# Copy the exported CoreML model that inference.py will load. The stateful
+# FormulaNet.mlpackage (encoder + beam search) needs macOS 15; macOS 14 gets the
+# standalone Encoder.mlpackage instead. Only one is installed since both hold
+# the encoder weights.
+FORMULANET_MLPACKAGE="$SCRIPT_DIR/../../models/FormulaNet.mlpackage"
+ENCODER_MLPACKAGE="$SCRIPT_DIR/../../models/Encoder.mlpackage"
+MACOS_MAJOR=$(sw_vers -productVersion 2>/dev/null | cut -d. -f1)
+rm -rf "$MATHSNIP_DIR/FormulaNet.mlpackage" "$MATHSNIP_DIR/Encoder.mlpackage"
+if [ -d "$FORMULANET_MLPACKAGE" ] && [ "${MACOS_MAJOR:-0}" -ge 15 ]; then
+    echo "Installing CoreML model..."
+    cp -r "$FORMULANET_MLPACKAGE" "$MATHSNIP_DIR/FormulaNet.mlpackage"
+elif [ -d "$ENCODER_MLPACKAGE" ]; then
+    echo "Installing CoreML encoder (the decoder runs in PyTorch before macOS 15)..."
+    cp -r "$ENCODER_MLPACKAGE" "$MATHSNIP_DIR/Encoder.mlpackage"
+else
+    echo "CoreML model not found (run 'make setup' for texo-coreml to export it), using PyTorch"
+fi
+
 # Pre-download the model
 echo ""
 echo "Downloading model..."